@@ -1,16 +1,47 @@
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 import os
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
 class CORSRequestHandler(SimpleHTTPRequestHandler):
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET')
-        self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate')
+        if self.path.lower().endswith(IMAGE_EXTENSIONS):
+            # Scraped images never change — let the browser cache them
+            self.send_header('Cache-Control', 'public, max-age=86400')
+        else:
+            self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate')
         return super().end_headers()
 
+    def copyfile(self, source, outputfile):
+        # Zero-copy kernel sendfile for regular files instead of a Python
+        # read/write loop; directory listings (BytesIO) take the default path
+        try:
+            in_fd = source.fileno()
+            out_fd = self.connection.fileno()
+        except (AttributeError, OSError):
+            return super().copyfile(source, outputfile)
+        if not hasattr(os, 'sendfile'):
+            return super().copyfile(source, outputfile)
+        outputfile.flush()
+        offset = 0
+        remaining = os.fstat(in_fd).st_size
+        try:
+            while remaining > 0:
+                sent = os.sendfile(out_fd, in_fd, offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+        except OSError:
+            source.seek(offset)
+            return super().copyfile(source, outputfile)
+
 if __name__ == '__main__':
     port = 3000
     print(f"Starting server at http://localhost:{port}")
     print("Press Ctrl+C to stop the server")
-    server = HTTPServer(('localhost', port), CORSRequestHandler)
-    server.serve_forever() 
\ No newline at end of file
+    # Threaded server: one slow xxlarge JPEG no longer blocks every other request
+    server = ThreadingHTTPServer(('localhost', port), CORSRequestHandler)
+    server.serve_forever()
@@ -1,3 +1,5 @@
+import io
+
 import google.generativeai as genai
 from PIL import Image
 
@@ -6,8 +8,20 @@ genai.configure(api_key="your-api-key")
 
 image_path = "/Users/keshav/Documents/GitHub/scraper/bing_database/Richard_Rogers/2be47867f0031d6397a19de7a3aeda70.jpg"
 
-# Load image
-image = Image.open(image_path)
+# Read raw bytes — passing a PIL image makes the SDK decode and re-encode it
+with open(image_path, "rb") as f:
+    image_bytes = f.read()
+mime_type = "image/jpeg" if image_bytes[:3] == b"\xff\xd8\xff" else "image/png"
+
+# Downscale to 1024px on the long edge — the model won't use more pixels,
+# so full-resolution uploads are just extra latency and tokens
+img = Image.open(io.BytesIO(image_bytes))
+if max(img.size) > 1024:
+    img.thumbnail((1024, 1024), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=85)
+    image_bytes = buf.getvalue()
+    mime_type = "image/jpeg"
 
 # Create model
 model = genai.GenerativeModel("gemini-1.5-flash")
@@ -29,7 +43,7 @@ Only return a single line in this exact format. Do not include explanations or e
 
 # Run a prompt
 response = model.generate_content(
-    [image, prompt]
+    [prompt, {"mime_type": mime_type, "data": image_bytes}]
 )
 
 print(response.text.strip() + ' , ' + image_path)
\ No newline at end of file
@@ -1,25 +1,37 @@
 #!/usr/bin/env python3
 import os
-import time
 import csv
+import random
+import asyncio
 import hashlib
-import requests
+import sqlite3
 from urllib.parse import urlparse, unquote
 
+import aiohttp
+
 # ————————————————
 # QUICK TEST MODE
 # ————————————————
 TEST_RUN = False  # one query per architect when True
 
 # ————————————————
-# OPTIONAL: 24 h HTTP response cache
+# OPTIONAL: 24 h HTTP response cache
 # ————————————————
 try:
-    import requests_cache
-    requests_cache.install_cache('google_cache', expire_after=86400)
-    print("✅ HTTP response caching enabled (24 h)")
+    from datetime import timedelta
+    from aiohttp_client_cache import CachedSession, SQLiteBackend
+    CACHE_BACKEND = SQLiteBackend(
+        'google_cache',
+        expire_after=timedelta(days=1),
+        cache_control=True,       # honor server Cache-Control / conditional requests
+        allowed_methods=['GET'],
+        ignored_params=['key'],   # keep the API key out of cache keys (and off disk)
+    )
+    print("✅ HTTP response caching enabled (Cache-Control aware, 24 h fallback)")
 except ImportError:
-    print("⚠️ requests_cache not installed; responses won’t be cached")
+    CachedSession = None
+    CACHE_BACKEND = None
+    print("⚠️ aiohttp-client-cache not installed; responses won’t be cached")
 
 # ————————————————
 # CONFIGURATION
@@ -36,6 +48,12 @@ if not API_KEY or not SEARCH_ENGINE_ID:
 # Now only two keywords: building and interior
 OR_TERMS = "building,interior"
 
+# Concurrency knobs: the workload is pure network I/O, so fan out and let the
+# semaphore (not sleeps) pace us against rate limits.
+PAGE_WORKERS          = 8    # concurrent search-API paginator tasks
+DOWNLOAD_WORKERS      = 64   # concurrent image download tasks
+MAX_INFLIGHT_DOWNLOADS = 64  # semaphore bound on simultaneous fetches
+
 ARCHITECTS_LIST = [
     "Frank Lloyd Wright","Le Corbusier","Ludwig Mies van der Rohe",
     "Walter Gropius","Zaha Hadid","Renzo Piano","I.M. Pei",
@@ -55,31 +73,47 @@ ARCHITECTS_LIST = [
 
 VALID_EXTENSIONS = ('.jpg', '.jpeg', '.png')
 
+# Cross-run dedup: CSE returns the same press photos under several architects.
+# Seen URLs/content hashes persist in DEDUP_DB (same philosophy as the HTTP
+# cache) and are loaded into these sets in main().
+DEDUP_DB    = os.path.join(BASE_DIR, "dedup.sqlite")
+SEEN_URLS   = set()
+SEEN_HASHES = set()
+DEDUP_CONN  = None
+
 
 # ————————————————
 # UTILITIES
 # ————————————————
-def robust_get(url, params=None, max_retries=3):
+def backoff_delay(attempt, base=1.0, cap=30):
+    """Full-jitter exponential backoff so parallel workers don't retry in lockstep."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def robust_get(session, url, params=None, max_retries=3):
     for attempt in range(1, max_retries+1):
-        resp = requests.get(url, params=params, timeout=30)
-        if resp.status_code == 400:
-            print(f"❌ 400 Bad Request: {resp.url}")
-            return None
-        if resp.status_code == 429:
-            reset = int(resp.headers.get("X-RateLimit-Reset", 60)) + 1
-            print(f"⚠️ Rate limit; sleeping {reset}s")
-            time.sleep(reset)
-            continue
         try:
-            resp.raise_for_status()
-            return resp
+            async with session.get(url, params=params,
+                                   timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                if resp.status in (400, 401, 403):
+                    # Unrecoverable client errors — retrying won't help
+                    print(f"❌ HTTP {resp.status}: {resp.url}")
+                    return None
+                if resp.status == 429 or resp.status >= 500:
+                    delay = backoff_delay(attempt)
+                    print(f"⚠️ HTTP {resp.status}; backing off {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                resp.raise_for_status()
+                return await resp.json()
         except Exception as e:
-            print(f"[{attempt}/{max_retries}] API error: {e}; retrying in 5s")
-            time.sleep(5)
+            delay = backoff_delay(attempt)
+            print(f"[{attempt}/{max_retries}] API error: {e}; retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
     return None
 
 
-def search_google_images(architect, start_index=1):
+async def search_google_images(session, architect, start_index=1):
     params = {
         "key":        API_KEY,
         "cx":         SEARCH_ENGINE_ID,
@@ -92,48 +126,74 @@ def search_google_images(architect, start_index=1):
         "imgType":     "photo",
         "rights":      "cc_publicdomain,cc_attribute,cc_sharealike",
         "safe":        "active",
-        "num":         10,
-        "start":       start_index
+        "num":         "10",
+        "start":       str(start_index)
     }
-    resp = robust_get(API_URL, params=params)
-    if not resp:
+    data = await robust_get(session, API_URL, params=params)
+    if not data:
         return [], None
-    data = resp.json()
     items = data.get("items", [])
     next_pages = data.get("queries", {}).get("nextPage", [])
     next_start = next_pages[0]["startIndex"] if next_pages else None
     return items, next_start
 
 
-def download_image_once(url, dest_folder):
-    try:
-        resp = requests.get(url, timeout=20)
-        if resp.status_code != 200:
-            print(f"⚠️ Skipping {url}: HTTP {resp.status_code}")
-            return None
-    except requests.RequestException as e:
-        print(f"⚠️ Failed to fetch {url}: {e}")
-        return None
-
+async def download_image_once(session, url, dest_folder):
+    # Validate the extension from the URL before spending a connection on it
     raw = unquote(os.path.basename(urlparse(url).path))
     name, ext = os.path.splitext(raw)
     if ext.lower() not in VALID_EXTENSIONS:
         return None
 
-    # Truncate long names + add MD5 suffix
-    if len(name) > 50:
-        h = hashlib.md5(raw.encode()).hexdigest()[:8]
-        name = name[:50] + "_" + h
-    filename = name + ext
-
+    # Collision-proof filename: basenames repeat across CDNs (every site has a
+    # photo.jpg), and with 64 concurrent writers a shared path means two
+    # downloads interleaving chunks into one corrupt file — so always append a
+    # short blake2b suffix derived from the full URL, not just for long names
+    h = hashlib.blake2b(url.encode(), digest_size=4).hexdigest()
+    filename = name[:50] + "_" + h + ext
     path = os.path.join(dest_folder, filename)
+
+    # Stream into a .part file and rename only once the body completes, so a
+    # mid-stream abort never leaves a truncated image that looks finished
+    part_path = path + ".part"
     try:
-        with open(path, "wb") as f:
-            f.write(resp.content)
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=20)) as resp:
+            if resp.status != 200:
+                print(f"⚠️ Skipping {url}: HTTP {resp.status}")
+                return None
+            # Stream straight to disk in 64 KB chunks — xxlarge JPEGs never
+            # sit fully in RAM, which matters with 64 downloads in flight.
+            # Hash the first 64 KB on the way through to catch byte-identical
+            # images fetched from different URLs.
+            hasher = hashlib.blake2b()
+            hashed = 0
+            with open(part_path, "wb") as f:
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    if hashed < 64 * 1024:
+                        take = chunk[:64 * 1024 - hashed]
+                        hasher.update(take)
+                        hashed += len(take)
+                    f.write(chunk)
+        digest = hasher.hexdigest()
+        if digest in SEEN_HASHES:
+            print(f"♻️ Duplicate content for {url}; removing {filename}")
+            os.remove(part_path)
+            return None
+        SEEN_HASHES.add(digest)
+        DEDUP_CONN.execute("INSERT OR IGNORE INTO seen_hashes VALUES (?)", (digest,))
+        DEDUP_CONN.commit()
+        os.replace(part_path, path)
         return path
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"⚠️ Failed to fetch {url}: {e}")
     except OSError as e:
         print(f"⚠️ OSError writing {path}: {e}")
-        return None
+    # Clean up whatever made it to disk before the failure
+    try:
+        os.remove(part_path)
+    except OSError:
+        pass
+    return None
 
 
 def create_arch_folder(architect):
@@ -145,52 +205,114 @@ def create_arch_folder(architect):
 # ————————————————
 # MAIN
 # ————————————————
-def main():
+async def main():
+    global DEDUP_CONN
     os.makedirs(BASE_DIR, exist_ok=True)
 
-    with open(METADATA_CSV, "w", newline="", encoding="utf-8") as csvf:
-        writer = csv.DictWriter(csvf, fieldnames=[
-            "architect", "image_url", "width", "height", "local_path"
-        ])
-        writer.writeheader()
-
-        for architect in ARCHITECTS_LIST:
-            print(f"\n=== Architect: {architect} ===")
-            arch_folder = create_arch_folder(architect)
-            start = 1
-
-            while start:
-                items, next_start = search_google_images(architect, start)
-                if not items:
-                    break
-
-                for item in items:
-                    url   = item.get("link")
-                    img   = item.get("image", {})
-                    w, h  = img.get("width"), img.get("height")
-                    local = download_image_once(url, arch_folder)
+    DEDUP_CONN = sqlite3.connect(DEDUP_DB)
+    DEDUP_CONN.execute("CREATE TABLE IF NOT EXISTS seen_urls (url TEXT PRIMARY KEY)")
+    DEDUP_CONN.execute("CREATE TABLE IF NOT EXISTS seen_hashes (hash TEXT PRIMARY KEY)")
+    SEEN_URLS.update(r[0] for r in DEDUP_CONN.execute("SELECT url FROM seen_urls"))
+    SEEN_HASHES.update(r[0] for r in DEDUP_CONN.execute("SELECT hash FROM seen_hashes"))
+    if SEEN_URLS or SEEN_HASHES:
+        print(f"♻️ Dedup state: {len(SEEN_URLS)} URLs, {len(SEEN_HASHES)} hashes from earlier runs")
+
+    # Producer/consumer pipeline: paginators fill a page queue, downloaders
+    # pull individual images, and a single writer task owns the CSV (csv
+    # writers aren't safe to share between tasks).
+    page_queue = asyncio.Queue()   # (architect, start_index)
+    dl_queue   = asyncio.Queue()   # (architect, search item)
+    row_queue  = asyncio.Queue()   # CSV rows
+    dl_sem     = asyncio.Semaphore(MAX_INFLIGHT_DOWNLOADS)
+
+    for architect in ARCHITECTS_LIST:
+        create_arch_folder(architect)
+        page_queue.put_nowait((architect, 1))
+
+    # One shared session for the whole run: pooled keep-alive connections and
+    # reused TLS sessions instead of a fresh handshake per image.
+    connector = aiohttp.TCPConnector(
+        limit=MAX_INFLIGHT_DOWNLOADS,
+        limit_per_host=10,   # don't hammer a single CDN host
+        keepalive_timeout=30
+    )
+    if CACHE_BACKEND:
+        session = CachedSession(cache=CACHE_BACKEND, connector=connector)
+    else:
+        session = aiohttp.ClientSession(connector=connector)
+
+    async with session:
+
+        async def page_worker():
+            while True:
+                architect, start = await page_queue.get()
+                try:
+                    items, next_start = await search_google_images(session, architect, start)
+                    for item in items:
+                        url = item.get("link")
+                        if url in SEEN_URLS:
+                            continue  # already downloaded (this run or a previous one)
+                        SEEN_URLS.add(url)
+                        dl_queue.put_nowait((architect, item))
+                    if items and next_start and not TEST_RUN:
+                        page_queue.put_nowait((architect, next_start))
+                finally:
+                    page_queue.task_done()
+
+        async def download_worker():
+            while True:
+                architect, item = await dl_queue.get()
+                try:
+                    url  = item.get("link")
+                    img  = item.get("image", {})
+                    w, h = img.get("width"), img.get("height")
+                    folder = os.path.join(BASE_DIR, architect.replace(" ", "_"))
+                    async with dl_sem:
+                        local = await download_image_once(session, url, folder)
                     if local:
-                        writer.writerow({
+                        # Persist the URL only on success so failures retry next run
+                        DEDUP_CONN.execute("INSERT OR IGNORE INTO seen_urls VALUES (?)", (url,))
+                        DEDUP_CONN.commit()
+                        row_queue.put_nowait({
                             "architect":  architect,
                             "image_url":  url,
                             "width":      w or "",
                             "height":     h or "",
                             "local_path": local
                         })
-                        print(f"✔️  saved {os.path.basename(local)} ({w}×{h})")
+                        print(f"✔️  {architect}: saved {os.path.basename(local)} ({w}×{h})")
                     else:
-                        print(f"✖️  skipped {url}")
+                        print(f"✖️  {architect}: skipped {url}")
+                finally:
+                    dl_queue.task_done()
 
-                    time.sleep(1)
+        async def csv_writer():
+            with open(METADATA_CSV, "w", newline="", encoding="utf-8") as csvf:
+                writer = csv.DictWriter(csvf, fieldnames=[
+                    "architect", "image_url", "width", "height", "local_path"
+                ])
+                writer.writeheader()
+                while True:
+                    row = await row_queue.get()
+                    try:
+                        writer.writerow(row)
+                    finally:
+                        row_queue.task_done()
 
-                if TEST_RUN:
-                    break
+        tasks = [asyncio.create_task(csv_writer())]
+        tasks += [asyncio.create_task(page_worker()) for _ in range(PAGE_WORKERS)]
+        tasks += [asyncio.create_task(download_worker()) for _ in range(DOWNLOAD_WORKERS)]
 
-                start = next_start
-                time.sleep(2)
+        # Pages feed downloads feed rows, so drain the queues in order.
+        await page_queue.join()
+        await dl_queue.join()
+        await row_queue.join()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
     print(f"\n🎉 Done! Metadata: {METADATA_CSV}, Images: {BASE_DIR}/")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -6,13 +6,13 @@ tag_google_images_gemini.py (v5 - loads full taxonomy)
    contain a 'local_path' column with the full path to each image file.
 2. **Loads the full tag taxonomy from tag_taxonomy.json.**
 3. If TEST_RUN is True, processes only the first TEST_RUN_LIMIT images.
-4. In parallel, sends each selected image specified by 'local_path' to the
-   specified Google Gemini vision model.
+4. Concurrently (asyncio, bounded by --workers) sends each selected image
+   specified by 'local_path' to the specified Google Gemini vision model.
 5. **The prompt now includes the full list of allowed tags from the taxonomy file.**
 6. Saves a new CSV <manifest_basename>_with_tags_gemini.csv (or _TEST if test run)
    in the same directory as the input manifest, adding a 'tags' column.
 
-Requires: pip install google-generativeai pandas tqdm Pillow tenacity google-api-core
+Requires: pip install google-generativeai pandas tqdm tenacity google-api-core orjson pyarrow aiolimiter Pillow
 Set API Key: export GOOGLE_API_KEY='YOUR_API_KEY'
 
 python3 tag_wikimedia_final.py \
@@ -21,23 +21,31 @@ python3 tag_wikimedia_final.py \
     --workers 12
 """
 
+import io
 import os
 import json
+import asyncio
+import hashlib
+import sqlite3
 import argparse
 import mimetypes # For determining image MIME type
 import time # For retry delay
 import sys # For exiting on error
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
 
+import orjson # Rust JSON codec — stdlib json shows up in profiles at 12+ workers
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import pandas as pd
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold, GenerateContentResponse
 # Import exceptions from google-api-core for retry logic
 from google.api_core import exceptions as google_exceptions
-from PIL import Image, UnidentifiedImageError # For image loading and format detection
+from PIL import Image # Only for downscaling before upload
 from tqdm import tqdm
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
+from aiolimiter import AsyncLimiter
 
 # --- Configuration ---
 
@@ -67,6 +75,24 @@ DEFAULT_SAFETY_SETTINGS = {
     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
 }
 
+# Vision models tile images at roughly 1k pixels a side — a 4000x3000 source
+# JPEG is 10-20x the bytes (and image tokens) the model can actually use.
+MAX_VISION_SIDE = 1024
+
+# Proactive request-rate cap shared by all workers. Retries only react to
+# 429s; the token bucket keeps us under quota so they rarely happen at all.
+GEMINI_REQUESTS_PER_MIN = 300
+RATE_LIMITER = AsyncLimiter(max_rate=GEMINI_REQUESTS_PER_MIN, time_period=60)
+
+# Uploaded-file reuse: identical images (re-runs, retries, duplicate rows)
+# resolve to one Gemini Files-API upload instead of re-sending the bytes.
+FILE_CACHE_DB  = "gemini_file_cache.sqlite"
+FILE_CACHE_TTL = 48 * 3600  # Gemini deletes uploaded files after ~48 h
+
+# The GenerativeModel handle, built once in main() after genai.configure —
+# constructing a fresh model (and internal client state) per call is wasted work
+MODEL = None
+
 # Define exceptions from google.api_core that trigger retries
 RETRYABLE_EXCEPTIONS = (
     google_exceptions.InternalServerError,  # For 500 errors
@@ -77,6 +103,65 @@ RETRYABLE_EXCEPTIONS = (
 
 # --- Core Functions ---
 
+def sniff_mime(header: bytes) -> str | None:
+    """Determines the image MIME type from magic bytes — no Pillow decode needed."""
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header.startswith(b'\x89PNG'):
+        return 'image/png'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if header.startswith(b'GIF8'):
+        return 'image/gif'
+    return None
+
+
+def downscale_image(img_bytes: bytes, mime_type: str) -> tuple[bytes, str]:
+    """Shrinks an image to MAX_VISION_SIDE on its long edge before upload."""
+    try:
+        img = Image.open(io.BytesIO(img_bytes))
+        if max(img.size) <= MAX_VISION_SIDE:
+            return img_bytes, mime_type
+        img.thumbnail((MAX_VISION_SIDE, MAX_VISION_SIDE), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=85)
+        return buf.getvalue(), "image/jpeg"
+    except Exception:
+        return img_bytes, mime_type  # undecodable? send the original and let the API decide
+
+
+def open_file_cache(db_root: Path) -> sqlite3.Connection:
+    """Opens the hash -> uploaded-file map (persists across runs, like the HTTP cache)."""
+    conn = sqlite3.connect(db_root / FILE_CACHE_DB)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS uploads (hash TEXT PRIMARY KEY, file_name TEXT, expires REAL)"
+    )
+    return conn
+
+
+async def get_or_upload_file(file_cache: sqlite3.Connection,
+                             img_bytes: bytes, mime_type: str):
+    """Returns a Gemini file reference for the image, uploading only on cache miss."""
+    digest = hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+    row = file_cache.execute(
+        "SELECT file_name, expires FROM uploads WHERE hash = ?", (digest,)
+    ).fetchone()
+    if row and row[1] > time.time():
+        try:
+            return await asyncio.to_thread(genai.get_file, row[0])
+        except Exception:
+            pass  # deleted server-side early; fall through and re-upload
+    f = await asyncio.to_thread(genai.upload_file, io.BytesIO(img_bytes), mime_type=mime_type)
+    file_cache.execute(
+        "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)",
+        (digest, f.name, time.time() + FILE_CACHE_TTL)
+    )
+    file_cache.commit()
+    return f
+
+
 def load_and_extract_tags(taxonomy_path: Path) -> list[str]:
     """Loads the JSON taxonomy and extracts a flat list of all tag strings."""
     if not taxonomy_path.is_file():
@@ -88,19 +173,23 @@ def load_and_extract_tags(taxonomy_path: Path) -> list[str]:
         with open(taxonomy_path, 'r', encoding='utf-8') as f:
             taxonomy_data = json.load(f)
 
-        # Recursively extract tags from nested dictionary/list structure
-        def extract_recursive(data):
-            if isinstance(data, dict):
-                for key, value in data.items():
-                    extract_recursive(value)
-            elif isinstance(data, list):
-                for item in data:
-                    if isinstance(item, str):
-                        all_tags.add(item)
-                    else: # Handle potential nested structures within lists
-                         extract_recursive(item)
-
-        extract_recursive(taxonomy_data)
+        # Walk the nested dict/list structure iteratively with an explicit
+        # stack — no Python frame per node, no RecursionError on deep
+        # taxonomies, and all-string leaf lists are absorbed in one C-level update
+        stack = deque([taxonomy_data])
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                stack.extend(node.values())
+            elif isinstance(node, list):
+                if all(isinstance(item, str) for item in node):
+                    all_tags.update(node)
+                else: # Handle potential nested structures within lists
+                    for item in node:
+                        if isinstance(item, str):
+                            all_tags.add(item)
+                        else:
+                            stack.append(item)
         print(f"Successfully loaded {len(all_tags)} unique tags from {taxonomy_path.name}")
         return sorted(list(all_tags)) # Return sorted list
 
@@ -114,19 +203,15 @@ def load_and_extract_tags(taxonomy_path: Path) -> list[str]:
 
 @retry(
     stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=2, max=10),
+    wait=wait_random_exponential(multiplier=1, max=30),  # jittered, avoids retry storms across workers
     retry=retry_if_exception_type(RETRYABLE_EXCEPTIONS),
     reraise=True
 )
-def call_gemini_api_with_retries(model_name: str, prompt_parts: list) -> GenerateContentResponse:
-    """Calls the Gemini API with retry logic for transient errors."""
+async def call_gemini_api_with_retries(prompt_parts: list) -> GenerateContentResponse:
+    """Calls the Gemini API asynchronously with retry logic for transient errors."""
     try:
-        model = genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=TAGGING_GENERATION_CONFIG, # Use tagging config
-            safety_settings=DEFAULT_SAFETY_SETTINGS
-        )
-        response = model.generate_content(prompt_parts)
+        async with RATE_LIMITER:
+            response = await MODEL.generate_content_async(prompt_parts)
         return response
     except Exception as e:
         # print(f"API Call Attempt Error during retry: {type(e).__name__} - {e}") # Can be noisy
@@ -139,23 +224,24 @@ def extract_json_array(text: str) -> list | None:
         end_index = text.rfind(']')
         if start_index != -1 and end_index != -1 and end_index >= start_index:
             json_str = text[start_index : end_index + 1]
-            parsed_json = json.loads(json_str)
+            parsed_json = orjson.loads(json_str)
             if isinstance(parsed_json, list):
                 return parsed_json
         else: # Fallback
             cleaned_text = text.strip().strip('`').strip()
             if cleaned_text.startswith("json"): cleaned_text = cleaned_text[4:].strip()
             if cleaned_text.startswith('[') and cleaned_text.endswith(']'):
-                 parsed_json = json.loads(cleaned_text)
+                 parsed_json = orjson.loads(cleaned_text)
                  if isinstance(parsed_json, list): return parsed_json
         return None
-    except json.JSONDecodeError: return None
+    except orjson.JSONDecodeError: return None
     except Exception as e:
         print(f"Warning: Unexpected error during JSON extraction: {type(e).__name__} from text: {text[:100]}...")
         return None
 
-def worker(idx: int, image_local_path: str | None, prompt_text: str, model_name: str) -> dict:
-    """Worker function executed by each thread for tagging."""
+async def worker(idx: int, image_local_path: str | None, prompt_text: str,
+                 allowed_tags: frozenset, file_cache: sqlite3.Connection) -> dict:
+    """Coroutine tagging a single image; many run concurrently under a semaphore."""
     out = {"idx": idx, "tags": []} # Default empty tags
 
     # Check if the provided path is valid before proceeding
@@ -173,14 +259,18 @@ def worker(idx: int, image_local_path: str | None, prompt_text: str, model_name:
 
     try:
         # --- Image Loading & API Call ---
-        img = Image.open(img_path); img.load()
-        mime_type = Image.MIME.get(img.format) or mimetypes.guess_type(img_path)[0]
+        # Read the file once and sniff the MIME from magic bytes; decoding the
+        # whole image with Pillow just to learn the format was wasted CPU.
+        img_bytes = img_path.read_bytes()
+        mime_type = sniff_mime(img_bytes[:12]) or mimetypes.guess_type(img_path)[0]
         if not mime_type or not mime_type.startswith('image/'):
              print(f"\nWarning index {idx}: Invalid MIME type for {img_path}. Assigning empty tags.")
              return out
-        img_bytes = img_path.read_bytes()
-        prompt_parts = [prompt_text, {"mime_type": mime_type, "data": img_bytes}]
-        response = call_gemini_api_with_retries(model_name, prompt_parts)
+        # Downscale off the event loop (Pillow decode is CPU-bound) then upload
+        img_bytes, mime_type = await asyncio.to_thread(downscale_image, img_bytes, mime_type)
+        file_ref = await get_or_upload_file(file_cache, img_bytes, mime_type)
+        prompt_parts = [prompt_text, file_ref]
+        response = await call_gemini_api_with_retries(prompt_parts)
 
         # --- Process Response ---
         tags = []
@@ -200,8 +290,10 @@ def worker(idx: int, image_local_path: str | None, prompt_text: str, model_name:
         else:
              reason = response.prompt_feedback.block_reason if response.prompt_feedback else "Unknown"
              print(f"\nAPI Error index {idx}: No candidates. Reason: {reason}. Assigning empty tags.")
-        out["tags"] = tags
-    except (FileNotFoundError, UnidentifiedImageError, PermissionError, google_exceptions.GoogleAPICallError, Exception) as e:
+        # Post-filter against the taxonomy set — the model can still hallucinate
+        # tags despite the prompt, and a set lookup is far cheaper than re-prompting
+        out["tags"] = [t for t in tags if t in allowed_tags]
+    except (FileNotFoundError, PermissionError, google_exceptions.GoogleAPICallError, Exception) as e:
         print(f"\nWorker Error index {idx} (Path: {img_path}): {type(e).__name__} - {e}. Assigning empty tags.")
         out["tags"] = []
     if 'tags' not in out: out['tags'] = []
@@ -221,7 +313,7 @@ def main():
     p.add_argument("--taxonomy", default=f"{GOOGLE_DB_BASE_PATH}/{TAG_TAXONOMY_FILENAME}",
                    help="Path to the tag_taxonomy.json file")
     p.add_argument("--model", default="gemini-1.5-flash-latest", help="Gemini model name")
-    p.add_argument("--workers", type=int, default=12, help="Parallel threads") # Defaulting to 12
+    p.add_argument("--workers", type=int, default=12, help="Max concurrent Gemini requests") # Defaulting to 12
     args = p.parse_args()
 
     # --- Configure API ---
@@ -230,6 +322,14 @@ def main():
     try: genai.configure(api_key=api_key); print("Google AI SDK configured successfully.")
     except Exception as e: p.error(f"Error configuring Google AI SDK: {e}")
 
+    # Build the model handle once; every worker call reuses it
+    global MODEL
+    MODEL = genai.GenerativeModel(
+        model_name=args.model,
+        generation_config=TAGGING_GENERATION_CONFIG,
+        safety_settings=DEFAULT_SAFETY_SETTINGS
+    )
+
     # --- Prepare Paths ---
     manifest_path = Path(args.manifest)
     taxonomy_path = Path(args.taxonomy) # Use path from argument
@@ -242,12 +342,19 @@ def main():
     if not allowed_tags_list:
          print("Error: No tags extracted from taxonomy. Exiting.")
          sys.exit(1)
-    allowed_tags_json_string = json.dumps(allowed_tags_list)
+    allowed_tags_json_string = orjson.dumps(allowed_tags_list).decode()
+    allowed_tags = frozenset(allowed_tags_list)  # built once, shared by all workers
 
     # --- Load Data ---
     print(f"Loading manifest from: {manifest_path}")
     try:
-        df_full = pd.read_csv(manifest_path)
+        # Arrow's multithreaded C++ parser: faster than pd.read_csv on big
+        # manifests, and Arrow-backed strings skip per-row Python objects
+        table = pacsv.read_csv(
+            manifest_path,
+            convert_options=pacsv.ConvertOptions(column_types={'local_path': pa.string()})
+        )
+        df_full = table.to_pandas(types_mapper=pd.ArrowDtype)
         if "local_path" not in df_full.columns: p.error("Manifest CSV must contain 'local_path'.")
         # Ensure path column is read as string, replacing NaN
         df_full['local_path'] = df_full['local_path'].fillna('').astype(str)
@@ -281,23 +388,37 @@ def main():
 Adherence to these rules and the provided tag list is critical.
 """
 
-    # --- Parallel Tagging ---
-    print(f"Starting image tagging for {len(df)} images with {args.workers} workers using model {args.model}...")
+    # --- Concurrent Tagging ---
+    # asyncio instead of a thread pool: each in-flight Gemini call costs a
+    # coroutine rather than a blocked OS thread, so concurrency can be raised
+    # without thread-stack memory or GIL context-switch overhead.
+    print(f"Starting image tagging for {len(df)} images with {args.workers} concurrent requests using model {args.model}...")
     results_map = {}
-    with ThreadPoolExecutor(max_workers=args.workers) as executor, tqdm(total=len(df), desc="Tagging Images", unit="image") as pbar:
-        futures_map = {
-            executor.submit(
-                worker, idx, row["local_path"], prompt_text, args.model
-            ): idx for idx, row in df.iterrows()
-        }
-        for future in as_completed(futures_map):
-            original_idx = futures_map[future]
-            try:
-                result = future.result()
-                if result and 'idx' in result: results_map[original_idx] = result.get("tags", [])
-                else: pbar.write(f"Warning: Invalid result idx {original_idx}. Assigning empty tags."); results_map[original_idx] = []
-            except Exception as e: pbar.write(f"Error processing idx {original_idx}: {type(e).__name__}. Assigning empty tags."); results_map[original_idx] = []
-            finally: pbar.update(1)
+
+    file_cache = open_file_cache(db_root)
+
+    async def run_tagging():
+        sem = asyncio.Semaphore(args.workers)
+
+        async def bound_worker(idx, local_path):
+            async with sem:
+                try:
+                    return await worker(idx, local_path, prompt_text, allowed_tags, file_cache)
+                except Exception as e:
+                    # worker catches its own errors; this is a last-resort net
+                    print(f"\nError processing idx {idx}: {type(e).__name__}. Assigning empty tags.")
+                    return {"idx": idx, "tags": []}
+
+        tasks = [asyncio.create_task(bound_worker(idx, row["local_path"]))
+                 for idx, row in df.iterrows()]
+        with tqdm(total=len(tasks), desc="Tagging Images", unit="image") as pbar:
+            for coro in asyncio.as_completed(tasks):
+                result = await coro
+                if result and 'idx' in result: results_map[result["idx"]] = result.get("tags", [])
+                else: pbar.write("Warning: Invalid worker result. Skipping.")
+                pbar.update(1)
+
+    asyncio.run(run_tagging())
 
     # --- Update DataFrame ---
     print("\nUpdating DataFrame with tags...")
@@ -322,11 +443,13 @@ Adherence to these rules and the provided tag list is critical.
         final_cols = [col for col in final_cols if col in df.columns] # Ensure columns exist in df slice
         df_out = df[final_cols].copy();
 
-        df_out['tags'] = df_out['tags'].apply(lambda x: json.dumps(x) if isinstance(x, list) else json.dumps([]))
+        df_out['tags'] = df_out['tags'].apply(lambda x: orjson.dumps(x).decode() if isinstance(x, list) else '[]')
         if 'local_path' in df_out.columns: # Ensure path column saved correctly
              df_out['local_path'] = df_out['local_path'].fillna('').astype(str)
 
-        df_out.to_csv(out_path, index=False, encoding='utf-8')
+        # Arrow's multithreaded C++ CSV writer — pandas' to_csv is pure-Python
+        # per-row and dominates wall time on 100k-row manifests
+        pacsv.write_csv(pa.Table.from_pandas(df_out, preserve_index=False), out_path)
         print(f"✅ Successfully wrote {len(df_out)} rows to {out_path}")
     except Exception as e: print(f"\nError writing CSV: {type(e).__name__} - {e}")
 
@@ -16,37 +16,91 @@ Usage:
     --taxonomy tag_taxonomy.json
 """
 
+import io
 import os
 import json
 import base64
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import orjson
 import pandas as pd
-import openai
+from openai import OpenAI
+from PIL import Image
+from ratelimit import limits, sleep_and_retry
 from tqdm import tqdm
 
+# Vision models only use ~1024px a side — bigger sources are wasted upload
+# bytes and image tokens
+MAX_VISION_SIDE = 1024
+
+# Shared request-rate cap across worker threads — smooths bursts so we stay
+# under the per-key quota instead of triggering 429s and backoffs
+OPENAI_CALLS_PER_MIN = 300
+
 def load_taxonomy(path):
     with open(path, 'r') as f:
         return json.load(f)
 
-def get_tags_for_image(image_path: str, system_prompt: str, model: str):
+def sniff_mime(header):
+    # Magic-byte sniff — filenames in the manifest can't be trusted
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header.startswith(b'\x89PNG'):
+        return 'image/png'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if header.startswith(b'GIF8'):
+        return 'image/gif'
+    return None
+
+def downscale_image(img_bytes, mime):
+    # Shrink to MAX_VISION_SIDE on the long edge before base64/upload
+    try:
+        img = Image.open(io.BytesIO(img_bytes))
+        if max(img.size) <= MAX_VISION_SIDE:
+            return img_bytes, mime
+        img.thumbnail((MAX_VISION_SIDE, MAX_VISION_SIDE), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=85)
+        return buf.getvalue(), "image/jpeg"
+    except Exception:
+        return img_bytes, mime  # undecodable? send as-is and let the API decide
+
+def get_tags_for_image(client, image_path: str, system_prompt: str, model: str):
     with open(image_path, "rb") as img_file:
-        img_b64 = base64.b64encode(img_file.read()).decode()
+        img_bytes = img_file.read()
+    mime = sniff_mime(img_bytes[:12]) or "image/jpeg"
+    img_bytes, mime = downscale_image(img_bytes, mime)
+    # Encode exactly once — the base64 str is already a third bigger than the
+    # raw bytes, so don't make extra copies along the way
+    img_b64 = base64.b64encode(img_bytes).decode("ascii")
 
     messages = [
         {"role": "system", "content": system_prompt},
         {
             "role": "user",
-            "content": "Assign all applicable tags from the taxonomy above.",
-            "image": {"data": img_b64, "mime": "image/png"}
+            "content": [
+                {"type": "text",
+                 "text": "Assign all applicable tags from the taxonomy above."},
+                {"type": "image_url",
+                 "image_url": {"url": f"data:{mime};base64,{img_b64}"}}
+            ]
         }
     ]
-    resp = openai.ChatCompletion.create(
+    resp = call_openai(client, model, messages)
+    return orjson.loads(resp.choices[0].message.content)
+
+@sleep_and_retry
+@limits(calls=OPENAI_CALLS_PER_MIN, period=60)
+def call_openai(client, model, messages):
+    return client.chat.completions.create(
         model=model,
         messages=messages,
         temperature=0.0
     )
-    return json.loads(resp.choices[0].message["content"])
 
 def find_image_file(db_root, architect, file_title):
     # Folder is architect with spaces → underscores
@@ -76,12 +130,15 @@ def main():
                    help="JSON taxonomy filename in the db folder, e.g. tag_taxonomy.json")
     p.add_argument("--model",    default="gpt-4o-mini",
                    help="Vision-enabled model to use")
+    p.add_argument("--workers",  type=int, default=12,
+                   help="Parallel threads for OpenAI calls")
     args = p.parse_args()
 
     # 1. Init
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    if not openai.api_key:
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
         p.error("Please set OPENAI_API_KEY in your environment")
+    client = OpenAI(api_key=api_key)
 
     db_root     = os.path.join(args.drive, args.db)
     manifest_fp = os.path.join(db_root, args.manifest)
@@ -99,31 +156,42 @@ def main():
     system_prompt = (
         "You are an architectural‑image tagging assistant.\n"
         "Here is the complete hierarchical taxonomy of allowed tags:\n"
-        f"{json.dumps(taxonomy)}\n\n"
+        f"{orjson.dumps(taxonomy).decode()}\n\n"
         "When I send you an image, reply with a JSON array of the exact tags that apply."
     )
 
-    # 2. Loop & tag
-    for idx, row in tqdm(df.iterrows(), total=len(df), desc="Tagging images"):
-        if isinstance(row["tags"], list) and row["tags"]:
-            continue  # skip if already done
-
-        arch       = row["architect"]
-        file_title = row["file_title"]
-
+    # 2. Tag in parallel — each call is seconds of pure network wait, so
+    # overlap the OpenAI roundtrips like tag_google_images_gemini_v5 does.
+    def worker(idx, arch, file_title):
         img_path = find_image_file(db_root, arch, file_title)
         if not img_path:
             print(f"⚠️  Missing file for {arch} / {file_title}")
-            df.at[idx, "tags"] = []
-            continue
-
+            return idx, []
         try:
-            tags = get_tags_for_image(img_path, system_prompt, args.model)
+            return idx, get_tags_for_image(client, img_path, system_prompt, args.model)
         except Exception as e:
             print(f"❌ Error on {arch}/{file_title}: {e}")
-            tags = []
+            return idx, []
+
+    # Filter already-tagged rows once, before submission
+    todo = [
+        (idx, row["architect"], row["file_title"])
+        for idx, row in df.iterrows()
+        if not (isinstance(row["tags"], list) and row["tags"])
+    ]
 
-        df.at[idx, "tags"] = tags
+    results = {}
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(worker, idx, arch, ft) for idx, arch, ft in todo]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Tagging images"):
+            idx, tags = future.result()
+            results[idx] = tags
+
+    # Single vectorized assignment (same pattern as tag_google_images_gemini_v5)
+    # instead of per-row df.at writes; rows skipped as already-tagged keep theirs
+    tags_series = pd.Series(results, name="tags")
+    df["tags"] = tags_series.combine_first(df["tags"])
+    df["tags"] = df["tags"].apply(lambda x: x if isinstance(x, list) else [])
 
     # 3. Write back
     df.to_csv(output_fp, index=False)